@@ -4,13 +4,15 @@ from urllib.parse import urlencode
 
 
 MAX_RESPONSE_SIZE = 100000000  # only when internal BytesIO is used
+BODY_CHECK_SIZE = 512  # how many bytes to collect before calling body_check
 
 
 class HttpError(Exception):
     '''
     General HTTP exception.
+    `response` attribute contains partially received response.
     '''
-    pass
+    response = None
 
 class ProxyError(Exception):
     '''
@@ -226,7 +228,8 @@ class CurlHttpSession:
             for k, v in params.items():
                 if isinstance(v, dict) and k in result:
                     # XXX this is for headers only, isn't it?
-                    result[k] |= v
+                    # make a copy, don't update defaults in place
+                    result[k] = result[k] | v
                 else:
                     result[k] = v
         if self.proxy is not None:
@@ -261,10 +264,14 @@ class CurlHttpSession:
 class CurlHttpRequest:
 
     def __init__(self, url, method, headers=None, proxy=None, connect_timeout=None, debug=None,
-                 post_data=None, form_data=None, response_file=None, resume_from=None):
+                 post_data=None, form_data=None, response_file=None, resume_from=None, body_check=None):
 
         # post_data, form_data - use one of
 
+        # body_check(response, body_beginning) is called from write callback
+        # as soon as BODY_CHECK_SIZE bytes are received;
+        # if it raises an exception, the transfer is aborted and perform() raises that exception
+
         self.url = url
         self.method = method
         self.easy_handle = None
@@ -275,6 +282,9 @@ class CurlHttpRequest:
             self.response_body = response_file
             self.response_external = True
         self.response_body_size = 0
+        self.body_check = body_check
+        self.body_beginning = b''
+        self.abort_exception = None
 
         self.easy_handle = c = acquire_easy_handle()
 
@@ -323,6 +333,18 @@ class CurlHttpRequest:
             raise ResponseTooLargeError()
         self.response_body.write(data)
 
+        if self.body_check is not None:
+            self.body_beginning += data[:BODY_CHECK_SIZE - len(self.body_beginning)]
+            if len(self.body_beginning) >= BODY_CHECK_SIZE:
+                body_check = self.body_check
+                self.body_check = None
+                try:
+                    body_check(self.response, self.body_beginning)
+                except Exception as e:
+                    # returning a number other than len(data) makes curl abort the transfer
+                    self.abort_exception = e
+                    return 0
+
     def close(self):
         self.response_body.close()
         if self.easy_handle is not None:
@@ -372,10 +394,14 @@ class CurlHttpRequest:
             self.response.content = self.response_body.getvalue()
 
         if not self.waiter.cancelled():
-            if errno in _possible_proxy_errors:
+            if self.abort_exception is not None:
+                self.waiter.set_exception(self.abort_exception)
+            elif errno in _possible_proxy_errors:
                 self.waiter.set_exception(ProxyError(self.url, errno, errmsg))
             else:
-                self.waiter.set_exception(HttpError(self.url, errno, errmsg))
+                error = HttpError(self.url, errno, errmsg)
+                error.response = self.response
+                self.waiter.set_exception(error)
         self.waiter = None
         self.close()
 
@@ -3,9 +3,13 @@ import json
 import os # XXX use aiofiles
 import re
 import traceback
+from functools import partial
 from urllib.parse import urljoin
 
 import http
+import packlib
+from indexlib import gallery_id_from_url
+from verifylib import verify_gallery
 
 
 retry_count = 5  # XXX make configurable?
@@ -17,32 +21,117 @@ class PageNotFound(Exception):
     pass
 
 
+def _check_page_beginning(url, response, page_beginning):
+    '''
+    Called by http module as soon as the beginning of the page is received,
+    raised exception aborts the transfer, and by fetch_page for the whole page.
+    206 is the status of resumed page, fresh requests never get it.
+    '''
+    if response.status not in ('200', '206'):
+        raise _TryAnotherProxy()
+
+    page_beginning = page_beginning.lower()
+
+    if b'it seems you are banned' in page_beginning:
+        raise _TryAnotherProxy()
+
+    if b'404 not found' in page_beginning:
+        raise PageNotFound(f'Page not found: {url}')
+
+
+def _received_content(response, partial_content):
+    '''
+    Return page content received so far, joining partial content with resumed part,
+    or None if resumed part does not match.
+    '''
+    if response is None or response.headers is None:
+        return None
+
+    if response.status == '200':
+        # fresh request or server sent whole page
+        return response.content
+
+    if partial_content is None or response.status != '206':
+        return None
+
+    response_headers = dict((k.lower(), v) for k, v in response.headers)
+    content_range = response_headers.get('content-range', '')
+    if not content_range.startswith(f'bytes {len(partial_content)}-'):
+        return None
+
+    return partial_content + response.content
+
+
+def _can_resume(response):
+    '''
+    Check if partial page can be fetched from received offset.
+    Offsets of encoded content do not match decoded one,
+    fetch_page requests identity encoding after the first truncated page.
+    '''
+    response_headers = dict((k.lower(), v) for k, v in response.headers)
+    if response_headers.get('content-encoding', 'identity') != 'identity':
+        return False
+    return response.status == '206' or response_headers.get('accept-ranges', '') == 'bytes'
+
+
+def _identity_encoding(kwargs):
+    '''
+    Request parameters to fetch page without compression, so it can be resumed.
+    '''
+    headers = dict(kwargs.get('headers', None) or {})
+    headers['Accept-Encoding'] = 'identity'
+    return dict(kwargs, headers=headers)
+
+
 async def fetch_page(session, url, **kwargs):
 
+    partial_content = None  # truncated page to resume
+    request_kwargs = kwargs  # switched to identity encoding after truncated page
+
     for _ in session.waysout:
         try:
             for _ in range(retry_count):
-                response = await session.get(url, **kwargs)
-                if response.status != '200':
-                    raise _TryAnotherProxy()
-
-                page_beginning = response.content[:512].lower()
+                try:
+                    if partial_content is None:
+                        response = await session.get(url, body_check=partial(_check_page_beginning, url), **request_kwargs)
+                    else:
+                        print('Resume from', len(partial_content))
+                        response = await session.get(url, resume_from=len(partial_content), **request_kwargs)
+
+                except http.HttpError as e:
+                    # transfer is broken, keep what's received if possible
+                    content = _received_content(e.response, partial_content)
+                    if content and _can_resume(e.response):
+                        partial_content = content
+                    else:
+                        partial_content = None
+                    if content:
+                        request_kwargs = _identity_encoding(kwargs)
+                    raise
 
-                if b'it seems you are banned' in page_beginning:
+                if partial_content is None and response.status != '200':
                     raise _TryAnotherProxy()
 
-                if b'404 not found' in page_beginning:
-                    raise PageNotFound(f'Page not found: {url}')
+                content = _received_content(response, partial_content)
+                if content is None:
+                    # cannot resume, fetch whole page
+                    partial_content = None
+                    continue
+
+                _check_page_beginning(url, response, content[:512])
 
-                if b'<html' not in page_beginning:
+                if b'<html' not in content[:512].lower():
                     # retry fetch partial page
+                    partial_content = None
                     continue
 
-                if b'</html>' not in response.content[-256:].lower():
+                if b'</html>' not in content[-256:].lower():
                     # retry fetch partial page
+                    partial_content = content if _can_resume(response) else None
+                    request_kwargs = _identity_encoding(kwargs)
                     continue
 
-                return response.content.decode('utf8'), response.real_url
+                return content.decode('utf8'), response.real_url
 
         except PageNotFound:
             raise
@@ -63,7 +152,16 @@ async def fetch_page(session, url, **kwargs):
     raise Exception(f'Unable to fetch {url}')
 
 
-async def fetch_gallery(session, url, dest_dir='.'):
+async def fetch_gallery(session, url, dest_dir='.', index=None, pack=False):
+    '''
+    Fetch gallery to {id}-{name} subdirectory of dest_dir
+    or, if pack is True, to {id}-{name}.tar
+    '''
+    if index is not None:
+        gallery_id = gallery_id_from_url(url)
+        if gallery_id is not None and index.is_complete(gallery_id):
+            print('Already archived', url)
+            return
 
     print('Fetching page', url)
     gallery_page, gallery_url = await fetch_page(session, url)
@@ -76,36 +174,87 @@ async def fetch_gallery(session, url, dest_dir='.'):
 
     gallery_info = extract_gallery_info(gallery_page, gallery_url)
 
-    gallery_dir = os.path.join(dest_dir, f'{gallery_info["id"]}-{gallery_info["name"]}')
-    os.makedirs(gallery_dir, exist_ok=True)
-
-    # write gallery info
-    with open(os.path.join(gallery_dir, 'info.json'), 'w', encoding='utf8') as f:
-        json.dump(
-            dict(
-                gallery_info = gallery_info,
-                images = images
-            ),
-            f,
-            indent = 4,
-            ensure_ascii = False
-        )
-
-    # gallery page does not contain direct links to full images,
-    # "click" on the first image to get navi-cavi element which does contain a few,
-    # fetch them, "click" on the next one after the last fetched image, and so on
-
-    image_index = 0
-    while image_index < len(images):
-        image_page, image_page_url = await fetch_page(session, images[image_index]['page_url'], headers={'Referer': gallery_url})
-        image_urls, total, idx = extract_navi_cavi(image_page, image_page_url)
-        if idx != image_index:
-            raise Exception(f'Image index {image_index} does not match extracted idx {idx}')
-        for i, image_url in enumerate(image_urls):
-            print('Fetching', image_url)
-            image_filename = os.path.join(gallery_dir, images[i + idx]['filename'])
-            await fetch_image(session, image_url, image_filename, headers={'Referer': image_page_url})
-        image_index += len(image_urls)
+    gallery_path = os.path.join(dest_dir, f'{gallery_info["id"]}-{gallery_info["name"]}')
+
+    info_json = json.dumps(
+        dict(
+            gallery_info = gallery_info,
+            images = images
+        ),
+        indent = 4,
+        ensure_ascii = False
+    )
+
+    gallery_tar = None
+    try:
+        # write gallery info
+        if pack:
+            gallery_path += packlib.tar_suffix
+            gallery_tar = packlib.GalleryTar(gallery_path)
+            if 'info.json' not in gallery_tar:
+                gallery_tar.add_bytes('info.json', info_json.encode('utf8'))
+        else:
+            os.makedirs(gallery_path, exist_ok=True)
+            with open(os.path.join(gallery_path, 'info.json'), 'w', encoding='utf8') as f:
+                f.write(info_json)
+
+        if index is not None:
+            index.update(gallery_info, gallery_path, len(images))
+
+        # gallery page does not contain direct links to full images,
+        # "click" on the first image to get navi-cavi element which does contain a few,
+        # fetch them, "click" on the next one after the last fetched image, and so on
+
+        image_index = 0
+        while image_index < len(images):
+            if gallery_tar is not None and images[image_index]['filename'] in gallery_tar:
+                # already packed, no need to fetch its page
+                _remove_stale_part(gallery_path, image_index)
+                image_index += 1
+                continue
+            image_page, image_page_url = await fetch_page(session, images[image_index]['page_url'], headers={'Referer': gallery_url})
+            image_urls, total, idx = extract_navi_cavi(image_page, image_page_url)
+            if idx != image_index:
+                raise Exception(f'Image index {image_index} does not match extracted idx {idx}')
+            for i, image_url in enumerate(image_urls):
+                image_filename = images[i + idx]['filename']
+                if gallery_tar is None:
+                    print('Fetching', image_url)
+                    await fetch_image(session, image_url, os.path.join(gallery_path, image_filename), headers={'Referer': image_page_url})
+                elif image_filename in gallery_tar:
+                    print('Already packed', image_filename)
+                    _remove_stale_part(gallery_path, i + idx)
+                else:
+                    # download to temporary file and append it to the tar
+                    print('Fetching', image_url)
+                    part_filename = _part_filename(gallery_path, i + idx)
+                    await fetch_image(session, image_url, part_filename, headers={'Referer': image_page_url})
+                    gallery_tar.add_file(image_filename, part_filename)
+                    os.remove(part_filename)
+            image_index += len(image_urls)
+    finally:
+        if gallery_tar is not None:
+            gallery_tar.close()
+
+    # fetch_image skips files of expected size, make sure they aren't broken
+    errors = verify_gallery(gallery_path)['errors']
+    for filename, message in errors:
+        print('Broken', os.path.join(gallery_path, filename), message)
+    if errors:
+        print('Gallery is incomplete', url)
+    elif index is not None:
+        index.set_complete(gallery_info['id'])
+
+
+def _part_filename(gallery_path, image_index):
+    # temporary file for image being downloaded to packed gallery
+    return f'{gallery_path}.{image_index}.part'
+
+def _remove_stale_part(gallery_path, image_index):
+    # left if interrupted after image has been added to the tar
+    part_filename = _part_filename(gallery_path, image_index)
+    if os.path.exists(part_filename):
+        os.remove(part_filename)
 
 
 _re_is_one_page = re.compile(r'<b>Detailed View</b>\s*</a>\s*&nbsp;\s*/\s*&nbsp;\s*<b>One Page</b>', re.I)
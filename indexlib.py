@@ -0,0 +1,174 @@
+'''
+Archive-wide gallery index.
+
+SQLite database in the archive directory with full text search
+over gallery name, description and user name.
+'''
+
+import os
+import re
+import sqlite3
+from urllib.parse import parse_qs, urlparse
+
+from packlib import load_gallery_info
+from verifylib import verify_gallery
+
+
+index_filename = 'index.sqlite'
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS galleries (
+    id          INTEGER PRIMARY KEY,
+    name        TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    username    TEXT NOT NULL,
+    userid      INTEGER,
+    path        TEXT NOT NULL,
+    num_images  INTEGER NOT NULL,
+    complete    INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS galleries_username ON galleries (username COLLATE NOCASE);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS galleries_fts USING fts5 (
+    name, description, username,
+    content = 'galleries', content_rowid = 'id'
+);
+
+CREATE TRIGGER IF NOT EXISTS galleries_ai AFTER INSERT ON galleries BEGIN
+    INSERT INTO galleries_fts (rowid, name, description, username)
+        VALUES (new.id, new.name, new.description, new.username);
+END;
+
+CREATE TRIGGER IF NOT EXISTS galleries_ad AFTER DELETE ON galleries BEGIN
+    INSERT INTO galleries_fts (galleries_fts, rowid, name, description, username)
+        VALUES ('delete', old.id, old.name, old.description, old.username);
+END;
+
+CREATE TRIGGER IF NOT EXISTS galleries_au AFTER UPDATE OF name, description, username ON galleries BEGIN
+    INSERT INTO galleries_fts (galleries_fts, rowid, name, description, username)
+        VALUES ('delete', old.id, old.name, old.description, old.username);
+    INSERT INTO galleries_fts (rowid, name, description, username)
+        VALUES (new.id, new.name, new.description, new.username);
+END;
+'''
+
+_re_gallery_path_id = re.compile('^/(?:gallery|pictures)/(\\d+)', re.I)
+
+def gallery_id_from_url(url):
+    '''
+    Extract gallery id from URL without fetching it.
+    Return None if URL does not contain gallery id.
+    '''
+    parsed_url = urlparse(url)
+    gid = parse_qs(parsed_url.query).get('gid', None)
+    if gid:
+        return gid[0]
+    matchobj = _re_gallery_path_id.match(parsed_url.path)
+    if matchobj:
+        return matchobj.group(1)
+    return None
+
+
+_columns = 'id, name, description, username, userid, path, num_images, complete'
+
+
+class GalleryIndex:
+    '''
+    How to use:
+
+        with GalleryIndex(archive_dir) as index:
+            if not index.is_complete(gallery_id):
+                ...
+    '''
+
+    def __init__(self, archive_dir='.'):
+        self.archive_dir = archive_dir
+        self.db = sqlite3.connect(os.path.join(archive_dir, index_filename))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, gallery_info, path, num_images, complete=False):
+        '''
+        Insert or update gallery record.
+        '''
+        with self.db:
+            self.db.execute(
+                f'''INSERT INTO galleries ({_columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        name = excluded.name,
+                        description = excluded.description,
+                        username = excluded.username,
+                        userid = excluded.userid,
+                        path = excluded.path,
+                        num_images = excluded.num_images,
+                        complete = excluded.complete''',
+                (
+                    int(gallery_info['id']),
+                    gallery_info['name'],
+                    gallery_info.get('description', ''),
+                    gallery_info['username'],
+                    gallery_info.get('userid', None),
+                    os.path.relpath(path, self.archive_dir),
+                    num_images,
+                    int(complete)
+                )
+            )
+
+    def set_complete(self, gallery_id, complete=True):
+        with self.db:
+            self.db.execute('UPDATE galleries SET complete = ? WHERE id = ?', (int(complete), int(gallery_id)))
+
+    def get(self, gallery_id):
+        '''
+        Return gallery record or None.
+        '''
+        return self.db.execute(f'SELECT {_columns} FROM galleries WHERE id = ?', (int(gallery_id),)).fetchone()
+
+    def is_complete(self, gallery_id):
+        row = self.get(gallery_id)
+        return row is not None and bool(row['complete'])
+
+    def by_user(self, username):
+        return self.db.execute(
+            f'SELECT {_columns} FROM galleries WHERE username = ? COLLATE NOCASE ORDER BY id',
+            (username,)
+        ).fetchall()
+
+    def search(self, query, limit=100):
+        '''
+        Full text search, query is in FTS5 syntax.
+        '''
+        return self.db.execute(
+            '''SELECT galleries.* FROM galleries_fts JOIN galleries ON galleries.id = galleries_fts.rowid
+                WHERE galleries_fts MATCH ? ORDER BY rank LIMIT ?''',
+            (query, limit)
+        ).fetchall()
+
+    def scan(self, galleries):
+        '''
+        Add existing gallery directories and packed galleries to the index.
+        Gallery is considered complete if all images listed in info.json pass verification.
+        Return number of indexed galleries.
+        '''
+        count = 0
+        for gallery_path in galleries:
+            try:
+                info = load_gallery_info(gallery_path)
+            except Exception as e:
+                print('Failed', gallery_path, str(e))
+                continue
+            complete = not verify_gallery(gallery_path)['errors']
+            self.update(info['gallery_info'], gallery_path, len(info['images']), complete)
+            count += 1
+        return count
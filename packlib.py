@@ -0,0 +1,264 @@
+'''
+Packed galleries: one uncompressed tar file per gallery instead of directory.
+
+Each tar has a sidecar index file {tar}.idx, JSON lines with member name,
+data offset, and size. A line is appended only after member data is written,
+so the index is used both for random access and for resuming interrupted writes.
+'''
+
+import json
+import os
+import shutil
+import tarfile
+import time
+
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+
+tar_suffix = '.tar'
+index_suffix = '.idx'
+
+
+def load_members(tar_path):
+    '''
+    Return dict of members: name -> (data offset, size).
+    Use sidecar index if exists and not empty, otherwise scan tar headers.
+    '''
+    members = _load_index(tar_path + index_suffix)
+    if members:
+        return members
+    return _scan_members(tar_path)
+
+
+def _load_index(index_path):
+    members = dict()
+    if os.path.exists(index_path):
+        with open(index_path, encoding='utf8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # incomplete last line
+                    break
+                members[entry['name']] = (entry['offset'], entry['size'])
+    return members
+
+
+def _scan_members(tar_path):
+    '''
+    Read tar headers, skip truncated member at the end.
+    '''
+    members = dict()
+    if not os.path.exists(tar_path):
+        return members
+    tar_size = os.path.getsize(tar_path)
+    try:
+        with tarfile.open(tar_path, 'r:') as tar:
+            for tarinfo in tar:
+                if tarinfo.isfile() and tarinfo.offset_data + tarinfo.size <= tar_size:
+                    members[tarinfo.name] = (tarinfo.offset_data, tarinfo.size)
+    except tarfile.ReadError:
+        # truncated header, keep what's been read
+        pass
+    return members
+
+
+def read_member(tar_path, name, members=None):
+    '''
+    Random access to member data.
+    '''
+    if members is None:
+        members = load_members(tar_path)
+    offset, size = members[name]
+    with open(tar_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def load_gallery_info(gallery_path):
+    '''
+    Load info.json from gallery directory or packed gallery.
+    '''
+    if gallery_path.endswith(tar_suffix):
+        return json.loads(read_member(gallery_path, 'info.json').decode('utf8'))
+    with open(os.path.join(gallery_path, 'info.json'), encoding='utf8') as f:
+        return json.load(f)
+
+
+class GalleryTar:
+    '''
+    Append-only tar writer.
+
+    How to use:
+
+        with GalleryTar(path) as tar:
+            if filename not in tar:
+                tar.add_file(filename, src_path)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + index_suffix
+
+        # tar headers are the source of truth, the index may be stale or broken;
+        # members dropped by remove() are in the tar but not in the index
+        scanned_members = _scan_members(path)
+        self.members = _load_index(self.index_path)
+        if not self.members or any(scanned_members.get(name) != member for name, member in self.members.items()):
+            self.members = scanned_members
+
+        # discard partially written member and end-of-archive blocks
+        end = 0
+        for offset, size in scanned_members.values():
+            end = max(end, offset + _padded(size))
+
+        self.tar_file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.index_file = None
+        try:
+            self.tar_file.truncate(end)
+            self.tar_file.seek(end)
+
+            # rewrite index, it could have been missing or had broken last line
+            self._write_index()
+        except Exception:
+            self.tar_file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def add_file(self, name, src_path):
+        with open(src_path, 'rb') as f:
+            self._add(name, f, os.fstat(f.fileno()).st_size)
+
+    def add_bytes(self, name, data):
+        self._add(name, None, len(data), data)
+
+    def remove(self, name):
+        '''
+        Drop member from the index, so it can be added again.
+        Its data remains in the tar as a dead space.
+        '''
+        del self.members[name]
+        self._write_index()
+
+    def read(self, name):
+        self.tar_file.flush()
+        return read_member(self.path, name, self.members)
+
+    def close(self):
+        if self.tar_file is None:
+            return
+        try:
+            # end-of-archive marker, truncated on next open
+            self.tar_file.write(b'\0' * (BLOCKSIZE * 2))
+            # make sure data is on disk, source files may be deleted after that
+            for f in (self.tar_file, self.index_file):
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            self.tar_file.close()
+            self.index_file.close()
+            self.tar_file = None
+            self.index_file = None
+
+    def _add(self, name, fileobj, size, data=None):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        header = tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+
+        offset = self.tar_file.tell() + len(header)
+        self.tar_file.write(header)
+        if fileobj is not None:
+            shutil.copyfileobj(fileobj, self.tar_file)
+        else:
+            self.tar_file.write(data)
+        self.tar_file.write(b'\0' * (_padded(size) - size))
+        self.tar_file.flush()
+
+        self.members[name] = (offset, size)
+        self.index_file.write(_index_line(name, offset, size))
+        self.index_file.flush()
+
+    def _write_index(self):
+        # write to temporary file and replace, so the index is never left half-written
+        if self.index_file is not None:
+            self.index_file.close()
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf8') as f:
+            for name, (offset, size) in self.members.items():
+                f.write(_index_line(name, offset, size))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.index_path)
+        self.index_file = open(self.index_path, 'a', encoding='utf8')
+
+
+def _index_line(name, offset, size):
+    return json.dumps(dict(name=name, offset=offset, size=size), ensure_ascii=False) + '\n'
+
+
+def _padded(size):
+    return (size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+
+
+def pack_gallery_dir(gallery_dir, remove=True):
+    '''
+    Convert gallery directory to packed gallery.
+    Gallery is not converted if any of images is missing or broken,
+    so that fetcher can resume it.
+
+    Return dict:
+        path: gallery directory
+        tar_path: packed gallery
+        gallery_info: from info.json, None if info.json is broken
+        num_images: number of images in info.json
+        errors: list of (filename, message)
+    '''
+    # verifylib depends on this module
+    from verifylib import check_image_file
+
+    result = dict(
+        path = gallery_dir,
+        tar_path = os.path.normpath(gallery_dir) + tar_suffix,
+        gallery_info = None,
+        num_images = 0,
+        errors = []
+    )
+    try:
+        info = load_gallery_info(gallery_dir)
+        result['gallery_info'] = info['gallery_info']
+        images = info['images']
+    except Exception as e:
+        result['errors'].append(('info.json', str(e)))
+        return result
+
+    result['num_images'] = len(images)
+    for image in images:
+        message = check_image_file(os.path.join(gallery_dir, image['filename']))
+        if message is not None:
+            result['errors'].append((image['filename'], message))
+    if result['errors']:
+        return result
+
+    try:
+        with GalleryTar(result['tar_path']) as tar:
+            for filename in ['info.json'] + [image['filename'] for image in images]:
+                if filename not in tar:
+                    tar.add_file(filename, os.path.join(gallery_dir, filename))
+
+        if remove:
+            shutil.rmtree(gallery_dir)
+
+    except OSError as e:
+        result['errors'].append((os.path.basename(result['tar_path']), str(e)))
+
+    return result
@@ -0,0 +1,232 @@
+'''
+Structural integrity checks for downloaded galleries.
+
+This module does not depend on pycurl, so it's safe to use in worker processes.
+'''
+
+import mmap
+import os
+
+from packlib import load_gallery_info, load_members, tar_suffix
+
+
+gallery_url_template = 'https://www.imagefap.com/gallery.php?gid={}'
+
+# chunk size for backward search of JPEG EOI marker
+_search_chunk_size = 65536
+
+# messages for images with recognized header and missing end,
+# only these are safe to remove and fetch again
+truncation_messages = frozenset([
+    'JPEG EOI marker is missing',
+    'GIF trailer is missing'
+])
+
+
+def check_image_data(data):
+    '''
+    Check image structure in a bytes-like object.
+    Return None if image looks complete or error message.
+    '''
+    size = len(data)
+    if size == 0:
+        return 'empty file'
+
+    if data[:2] == b'\xff\xd8':
+        return _check_jpeg(data, size)
+
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return _check_gif(data, size)
+
+    return 'unknown image format'
+
+
+def _check_jpeg(data, size):
+    '''
+    Walk marker segments up to the first scan, then look for EOI after it.
+    Markers inside entropy-coded data are byte-stuffed, so FF D9 there can only be EOI.
+    Data appended after EOI is fine.
+    '''
+    pos = 2
+    while True:
+        if pos + 2 > size:
+            return 'JPEG EOI marker is missing'
+        if data[pos] != 0xff:
+            return 'JPEG marker structure is broken'
+        marker = data[pos + 1]
+        if marker == 0xff:
+            # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            # standalone markers
+            pos += 2
+            continue
+        if marker == 0xd9:
+            return 'JPEG has no image data'
+        if pos + 4 > size:
+            return 'JPEG EOI marker is missing'
+        segment_end = pos + 2 + (data[pos + 2] << 8 | data[pos + 3])
+        if segment_end > size:
+            return 'JPEG EOI marker is missing'
+        if marker == 0xda:
+            break
+        pos = segment_end
+
+    if _rfind(data, b'\xff\xd9', segment_end, size) < 0:
+        return 'JPEG EOI marker is missing'
+    return None
+
+
+def _rfind(data, pattern, start, end):
+    '''
+    Backward search in a bytes-like object without copying all of it.
+    '''
+    while end > start:
+        chunk_start = max(start, end - _search_chunk_size)
+        # overlap chunks so that pattern on the boundary is found
+        found = bytes(data[chunk_start:min(end + len(pattern) - 1, len(data))]).rfind(pattern)
+        if found >= 0:
+            return chunk_start + found
+        end = chunk_start
+    return -1
+
+
+def _check_gif(data, size):
+    '''
+    Walk GIF blocks up to the trailer. Data appended after the trailer is fine.
+    '''
+    try:
+        # logical screen descriptor, global color table
+        pos = 13
+        flags = data[10]
+        if flags & 0x80:
+            pos += 3 << ((flags & 7) + 1)
+
+        while True:
+            block_type = data[pos]
+            if block_type == 0x3b:
+                return None
+            if block_type == 0x2c:
+                # image descriptor, local color table, LZW minimum code size
+                flags = data[pos + 9]
+                pos += 10
+                if flags & 0x80:
+                    pos += 3 << ((flags & 7) + 1)
+                pos += 1
+            elif block_type == 0x21:
+                # extension label
+                pos += 2
+            else:
+                return 'GIF block structure is broken'
+
+            # data sub-blocks
+            while True:
+                block_size = data[pos]
+                pos += 1 + block_size
+                if block_size == 0:
+                    break
+
+    except IndexError:
+        return 'GIF trailer is missing'
+
+
+def check_image_file(filename):
+    '''
+    Check image file using memory-mapped read.
+    Return None if image looks complete or error message.
+    '''
+    try:
+        file_size = os.path.getsize(filename)
+        if file_size == 0:
+            return 'empty file'
+
+        with open(filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return check_image_data(data)
+
+    except FileNotFoundError:
+        return 'missing'
+
+    except (OSError, ValueError) as e:
+        return str(e)
+
+
+def verify_gallery(gallery_path):
+    '''
+    Check all images listed in info.json of gallery directory or packed gallery.
+
+    Return dict:
+        path: gallery directory or packed gallery
+        gallery_id: from info.json or, if it is broken, from {id}-{name} path, None if unknown
+        errors: list of (filename, message)
+    '''
+    result = dict(
+        path = gallery_path,
+        gallery_id = None,
+        errors = []
+    )
+    try:
+        info = load_gallery_info(gallery_path)
+        result['gallery_id'] = info['gallery_info']['id']
+        images = info['images']
+    except Exception as e:
+        result['gallery_id'] = gallery_id_from_path(gallery_path)
+        result['errors'].append(('info.json', str(e)))
+        return result
+
+    if gallery_path.endswith(tar_suffix):
+        try:
+            _verify_tar_images(gallery_path, images, result['errors'])
+        except (OSError, ValueError) as e:
+            result['errors'].append((os.path.basename(gallery_path), str(e)))
+    else:
+        for image in images:
+            message = check_image_file(os.path.join(gallery_path, image['filename']))
+            if message is not None:
+                result['errors'].append((image['filename'], message))
+
+    return result
+
+
+def gallery_id_from_path(gallery_path):
+    '''
+    Extract gallery id from {id}-{name} directory or {id}-{name}.tar file name.
+    '''
+    gallery_id = os.path.basename(os.path.normpath(gallery_path)).split('-', 1)[0]
+    if gallery_id.isdigit():
+        return gallery_id
+    return None
+
+
+def _verify_tar_images(tar_path, images, errors):
+    members = load_members(tar_path)
+    with open(tar_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for image in images:
+                member = members.get(image['filename'], None)
+                if member is None:
+                    errors.append((image['filename'], 'missing'))
+                    continue
+                offset, size = member
+                if offset + size > len(data):
+                    errors.append((image['filename'], 'tar member is truncated'))
+                    continue
+                with memoryview(data)[offset:offset + size] as image_data:
+                    message = check_image_data(image_data)
+                if message is not None:
+                    errors.append((image['filename'], message))
+
+
+def find_galleries(archive_dir):
+    '''
+    Yield gallery directories, i.e. subdirectories of archive_dir that contain info.json,
+    and packed galleries.
+    '''
+    with os.scandir(archive_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if os.path.exists(os.path.join(entry.path, 'info.json')):
+                    yield entry.path
+            elif entry.name.endswith(tar_suffix):
+                yield entry.path